@@ -4,25 +4,29 @@ import os
 import signal
 import ssl
 import time
-import json
 import re
 import base64
 import uuid
 import hmac
-import hashlib
 import random
-from queue import Queue
-from threading import Timer
-from multiprocessing import Process
+from collections import deque
+from threading import Event
 import requests
 import paho.mqtt.client as mqtt
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 from prometheus_client import start_http_server, REGISTRY, Gauge, Counter
+from prometheus_client.core import GaugeMetricFamily
 
 
-class RepeatTimer(Timer):
-    def run(self):
-        while not self.finished.wait(self.interval):
-            self.function(*self.args, **self.kwargs)
+# Insert an underscore before every uppercase letter that does not already follow one
+CAMEL_CASE_BOUNDARY_RE = re.compile(r'(?<=[^_])([A-Z])')
+# https://prometheus.io/docs/concepts/data_model/#metric-names-and-labels
+PROMETHEUS_METRIC_NAME_RE = re.compile(r'^[a-zA-Z_:][a-zA-Z0-9_:]*$')
+# Payload value types that can be exported as gauge values
+NUMERIC_TYPES = (int, float)
 
 
 class EcoflowMetricException(Exception):
@@ -39,26 +43,29 @@ class EcoflowAuthentication:
         self.mqtt_username = None
         self.mqtt_password = None
         self.mqtt_client_id = None
+        # Reuse pooled connections across API calls; headers that never change are set on the session once
+        self.session = requests.Session()
+        self.session.headers.update({
+            "accessKey": ecoflow_access_key,
+            "Content-Type": "application/json;charset=UTF-8"
+        })
+        self.access_key_field = f"accessKey={ecoflow_access_key}".encode('utf-8')
+        # Key the HMAC once; every signature starts from a copy of this already-keyed state. The digest is named as a
+        # string, so hashlib does not need to be imported
+        self.signature_hmac = hmac.new(ecoflow_secret_key.encode('utf-8'), digestmod="sha256")
         self.authorize()
 
     def generate_signature(self, params, nonce, timestamp):
         """Generate HMAC-SHA256 signature for EcoFlow API requests."""
-        # Sort parameters by key
-        sorted_params = sorted(params.items())
-        # Create query string
-        param_str = '&'.join([f"{k}={v}" for k, v in sorted_params])
-        # Create message to sign: params&accessKey=value&nonce=value&timestamp=value
-        if param_str:
-            message = f"{param_str}&accessKey={self.ecoflow_access_key}&nonce={nonce}&timestamp={timestamp}"
-        else:
-            message = f"accessKey={self.ecoflow_access_key}&nonce={nonce}&timestamp={timestamp}"
+        # Create message to sign: params&accessKey=value&nonce=value&timestamp=value, with params sorted by key
+        fields = [f"{k}={v}".encode('utf-8') for k, v in sorted(params.items())]
+        fields.append(self.access_key_field)
+        fields.append(b"nonce=" + nonce.encode('utf-8'))
+        fields.append(b"timestamp=" + timestamp.encode('utf-8'))
         # Generate HMAC-SHA256 signature
-        signature = hmac.new(
-            self.ecoflow_secret_key.encode('utf-8'),
-            message.encode('utf-8'),
-            hashlib.sha256
-        ).hexdigest()
-        return signature
+        signature = self.signature_hmac.copy()
+        signature.update(b"&".join(fields))
+        return signature.hexdigest()
 
     def call_api(self, endpoint, params=None):
         """Make authenticated API call to EcoFlow Developer API."""
@@ -72,20 +79,15 @@ class EcoflowAuthentication:
         # Generate signature
         sign = self.generate_signature(params, nonce, timestamp)
         
-        # Prepare headers
+        # Prepare per-request headers, the rest are set on the session
         headers = {
-            "accessKey": self.ecoflow_access_key,
             "nonce": nonce,
             "timestamp": timestamp,
-            "sign": sign,
-            "Content-Type": "application/json;charset=UTF-8"
+            "sign": sign
         }
         
         # Make request (GET for now, can be extended for POST)
-        if params:
-            response = requests.get(url, params=params, headers=headers)
-        else:
-            response = requests.get(url, headers=headers)
+        response = self.session.get(url, params=params, headers=headers)
         
         return self.get_json_response(response)
 
@@ -121,7 +123,7 @@ class EcoflowAuthentication:
             raise Exception(f"Got HTTP status code {request.status_code}: {request.text}")
 
         try:
-            response = json.loads(request.text)
+            response = json_loads(request.content)
             response_message = response["message"]
         except KeyError as key:
             raise Exception(f"Failed to extract key {key} from {response}")
@@ -134,6 +136,35 @@ class EcoflowAuthentication:
         return response
 
 
+class MessageQueue:
+    # Single-producer/single-consumer handoff from the MQTT network thread to the Worker. deque.append() and
+    # deque.popleft() are atomic and need no lock. The Event only exists to wake up an idle Worker, and it is set
+    # (taking its internal lock) only for the first message after each drain()
+    def __init__(self):
+        self.messages = deque()
+        self.arrived = Event()
+
+    def put(self, message):
+        self.messages.append(message)
+        # Safe without a lock: the message is appended before the check, and drain() clears before popping
+        if not self.arrived.is_set():
+            self.arrived.set()
+
+    def wait(self, timeout):
+        return self.arrived.wait(timeout)
+
+    def drain(self):
+        # Clear before draining: a message appended after this point is either drained below or sets the Event again
+        self.arrived.clear()
+        batch = []
+        try:
+            while True:
+                batch.append(self.messages.popleft())
+        except IndexError:
+            pass
+        return batch
+
+
 class EcoflowMQTT():
 
     def __init__(self, message_queue, device_sn, username, password, addr, port, client_id, timeout_seconds):
@@ -149,14 +180,12 @@ class EcoflowMQTT():
         self.timeout_seconds = timeout_seconds
         self.last_message_time = None
         self.client = None
+        self.connected = Event()
 
         self.connect()
 
-        self.idle_timer = RepeatTimer(10, self.idle_reconnect)
-        self.idle_timer.daemon = True
-        self.idle_timer.start()
-
     def connect(self):
+        first_connection = self.client is None
         if self.client:
             self.client.loop_stop()
             self.client.disconnect()
@@ -168,38 +197,46 @@ class EcoflowMQTT():
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
+        self.client.on_connect_fail = self.on_connect_fail
+        # Bound the TCP and TLS handshake so that a dead broker cannot hang the network thread
+        self.client.connect_timeout = 30
+        # Let the network thread back off between automatic reconnects after a dropped connection
+        self.client.reconnect_delay_set(min_delay=1, max_delay=30)
+        self.connected.clear()
 
         log.info(f"Connecting to MQTT Broker {self.addr}:{self.port} using client id {self.client_id}")
-        self.client.connect(self.addr, self.port)
+        if first_connection:
+            # Connect synchronously at startup so that a wrong broker host or port fails loudly instead of being
+            # retried silently by the network thread
+            self.client.connect(self.addr, self.port)
+        else:
+            # On reconnects the connection is made by the network thread started in loop_start(), so this never blocks
+            self.client.connect_async(self.addr, self.port)
         self.client.loop_start()
 
     def idle_reconnect(self):
-        if self.last_message_time and time.time() - self.last_message_time > self.timeout_seconds:
+        # Called from the Worker loop on every collecting tick. last_message_time uses the monotonic clock so that
+        # wall-clock adjustments cannot trigger or suppress a reconnect
+        if self.last_message_time and time.monotonic() - self.last_message_time > self.timeout_seconds:
             log.error(f"No messages received for {self.timeout_seconds} seconds. Reconnecting to MQTT")
-            # We pull the following into a separate process because there are actually quite a few things that can go
-            # wrong inside the connection code, including it just timing out and never returning. So this gives us a
-            # measure of safety around reconnection
-            while True:
-                connect_process = Process(target=self.connect)
-                connect_process.start()
-                connect_process.join(timeout=60)
-                connect_process.terminate()
-                if connect_process.exitcode == 0:
-                    log.info("Reconnection successful, continuing")
-                    # Reset last_message_time here to avoid a race condition between idle_reconnect getting called again
-                    # before on_connect() or on_message() are called
-                    self.last_message_time = None
-                    break
-                else:
-                    log.error("Reconnection errored out, or timed out, attempted to reconnect...")
+            # There are quite a few things that can go wrong inside the connection code, including it just timing out
+            # and never returning. Connecting asynchronously and waiting for on_connect() with a deadline gives us a
+            # measure of safety around reconnection; a stuck client is torn down by the next connect(). Only one attempt
+            # is made per call so that the Worker loop keeps ticking, a failed attempt is retried on a later tick
+            self.connect()
+            if self.connected.wait(timeout=60):
+                log.info("Reconnection successful, continuing")
+            else:
+                log.error("Reconnection errored out, or timed out, will retry on the next collecting tick")
 
     def on_connect(self, client, userdata, flags, reason_code, properties):
         # Initialize the time of last message at least once upon connection so that other things that rely on that to be
         # set (like idle_reconnect) work
-        self.last_message_time = time.time()
+        self.last_message_time = time.monotonic()
         if reason_code == "Success":
-            self.client.subscribe(self.topic)
+            self.client.subscribe(self.topic, qos=0)
             log.info(f"Subscribed to MQTT topic {self.topic}")
+            self.connected.set()
         elif reason_code == "Keep alive timeout":
             log.error("Failed to connect to MQTT: connection timed out")
         elif reason_code == "Unsupported protocol version":
@@ -217,14 +254,17 @@ class EcoflowMQTT():
 
         return client
 
+    def on_connect_fail(self, client, userdata):
+        log.error(f"Failed to connect to MQTT Broker {self.addr}:{self.port}. Will retry")
+
     def on_disconnect(self, client, userdata, flags, reason_code, properties):
         if reason_code > 0:
             log.error(f"Unexpected MQTT disconnection: {reason_code}. Will auto-reconnect")
-            time.sleep(5)
 
     def on_message(self, client, userdata, message):
-        self.message_queue.put(message.payload.decode("utf-8"))
-        self.last_message_time = time.time()
+        # Both parsers accept bytes, so the payload is queued as-is without decoding it first
+        self.message_queue.put(message.payload)
+        self.last_message_time = time.monotonic()
 
 
 class EcoflowMetric:
@@ -232,20 +272,17 @@ class EcoflowMetric:
         self.ecoflow_payload_key = ecoflow_payload_key
         self.device_name = device_name
         self.name = f"ecoflow_{self.convert_ecoflow_key_to_prometheus_name()}"
-        self.metric = Gauge(self.name, f"value from MQTT object key {ecoflow_payload_key}", labelnames=["device"])
+        self.documentation = f"value from MQTT object key {ecoflow_payload_key}"
+        # None means no data, the sample is left out of the scrape
+        self.value = None
 
     def convert_ecoflow_key_to_prometheus_name(self):
         # bms_bmsStatus.maxCellTemp -> bms_bms_status_max_cell_temp
         # pd.ext4p8Port -> pd_ext4p8_port
         key = self.ecoflow_payload_key.replace('.', '_')
-        new = key[0].lower()
-        for character in key[1:]:
-            if character.isupper() and not new[-1] == '_':
-                new += '_'
-            new += character.lower()
+        new = CAMEL_CASE_BOUNDARY_RE.sub(r'_\1', key).lower()
         # Check that metric name complies with the data model for valid characters
-        # https://prometheus.io/docs/concepts/data_model/#metric-names-and-labels
-        if not re.match("[a-zA-Z_:][a-zA-Z0-9_:]*", new):
+        if not PROMETHEUS_METRIC_NAME_RE.match(new):
             raise EcoflowMetricException(f"Cannot convert payload key {self.ecoflow_payload_key} to comply with the Prometheus data model. Please, raise an issue!")
         return new
 
@@ -253,46 +290,97 @@ class EcoflowMetric:
         # According to best practices for naming metrics and labels, the voltage should be in volts and the current in amperes
         # WARNING! This will ruin all Prometheus historical data and backward compatibility of Grafana dashboard
         # value = value / 1000 if value.endswith("_vol") or value.endswith("_amp") else value
-        log.debug(f"Set {self.name} = {value}")
-        self.metric.labels(device=self.device_name).set(value)
+        if log.getLogger().isEnabledFor(log.DEBUG):
+            log.debug("Set %s = %s", self.name, value)
+        # Only the Worker thread writes values and the scrape thread only reads them. Rebinding an attribute is atomic,
+        # so unlike Gauge.set() no lock is taken per update
+        self.value = float(value)
 
     def clear(self):
-        log.debug(f"Clear {self.name}")
-        self.metric.clear()
+        if log.getLogger().isEnabledFor(log.DEBUG):
+            log.debug("Clear %s", self.name)
+        self.value = None
+
+    def collect(self):
+        metric = GaugeMetricFamily(self.name, self.documentation, labels=["device"])
+        # Read the value once, the Worker thread may clear() it between a check and a second read
+        value = self.value
+        if value is not None:
+            metric.add_metric([self.device_name], value)
+        return metric
+
+
+class EcoflowMetricCollector:
+    # A single registered collector exposes every payload metric at scrape time, instead of registering a separate
+    # Gauge for each payload key. Metric names stay the same, so existing dashboards and alerts keep working
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def collect(self):
+        # Copy first, the Worker may add metrics while the HTTP server thread is scraping
+        for metric in list(self.metrics.values()):
+            yield metric.collect()
 
 
 class Worker:
-    def __init__(self, message_queue, device_name, collecting_interval_seconds=10):
+    def __init__(self, message_queue, device_name, collecting_interval_seconds=10, ecoflow_mqtt=None):
         self.message_queue = message_queue
+        self.mqtt = ecoflow_mqtt
         self.device_name = device_name
         self.collecting_interval_seconds = collecting_interval_seconds
-        self.metrics_collector = []
+        self.metrics = {}
+        REGISTRY.register(EcoflowMetricCollector(self.metrics))
+        # The collector has no describe(), so the registry cannot catch duplicates. Track every name in the scrape
+        # output ourselves, a duplicated metric family would make Prometheus reject the whole scrape
+        self.metric_names = {"ecoflow_online", "ecoflow_mqtt_messages_receive_total", "ecoflow_mqtt_messages_receive_created"}
+        # Payload keys that cannot be exported, remembered so that they are rejected and logged only once
+        self.skipped_keys = set()
         self.online = Gauge("ecoflow_online", "1 if device is online", labelnames=["device"])
         self.mqtt_messages_receive_total = Counter("ecoflow_mqtt_messages_receive_total", "total MQTT messages", labelnames=["device"])
+        self.online_child = self.online.labels(self.device_name)
+        self.mqtt_messages_receive_total_child = self.mqtt_messages_receive_total.labels(self.device_name)
 
     def loop(self):
-        time.sleep(self.collecting_interval_seconds)
+        # While messages are flowing, sleep a full interval between ticks so that they are processed in batches. Once a
+        # tick finds the queue empty, block on the queue instead: back off up to 4 intervals while the device stays
+        # silent, and wake up as soon as it sends something again
+        max_wait_seconds = self.collecting_interval_seconds * 4
+        wait_seconds = self.collecting_interval_seconds
+        idle = True
         while True:
-            queue_size = self.message_queue.qsize()
+            if idle:
+                self.message_queue.wait(wait_seconds)
+            else:
+                time.sleep(wait_seconds)
+
+            # Drain everything queued since the last tick in one pass so the size used below matches what gets processed
+            batch = self.message_queue.drain()
+
+            queue_size = len(batch)
             if queue_size > 0:
                 log.info(f"Processing {queue_size} event(s) from the message queue")
-                self.online.labels(device=self.device_name).set(1)
-                self.mqtt_messages_receive_total.labels(device=self.device_name).inc(queue_size)
+                self.online_child.set(1)
+                self.mqtt_messages_receive_total_child.inc(queue_size)
+                idle = False
+                wait_seconds = self.collecting_interval_seconds
             else:
                 log.info("Message queue is empty. Assuming that the device is offline")
-                self.online.labels(device=self.device_name).set(0)
+                self.online_child.set(0)
                 # Clear metrics for NaN (No data) instead of last value
-                for metric in self.metrics_collector:
+                for metric in self.metrics.values():
                     metric.clear()
+                idle = True
+                wait_seconds = min(wait_seconds * 2, max_wait_seconds)
 
-            while not self.message_queue.empty():
-                payload = self.message_queue.get()
-                log.debug(f"Recived payload: {payload}")
+            for payload in batch:
+                # Debug logging sits on the per-message path, so skip it entirely unless it will be emitted
+                if log.getLogger().isEnabledFor(log.DEBUG):
+                    log.debug("Recived payload: %s", payload)
                 if payload is None:
                     continue
 
                 try:
-                    payload = json.loads(payload)
+                    payload = json_loads(payload)
                     params = payload['params']
                 except KeyError as key:
                     log.error(f"Failed to extract key {key} from payload: {payload}")
@@ -301,38 +389,45 @@ class Worker:
                     continue
                 self.process_payload(params)
 
-            time.sleep(self.collecting_interval_seconds)
-
-    def get_metric_by_ecoflow_payload_key(self, ecoflow_payload_key):
-        for metric in self.metrics_collector:
-            if metric.ecoflow_payload_key == ecoflow_payload_key:
-                log.debug(f"Found metric {metric.name} linked to {ecoflow_payload_key}")
-                return metric
-        log.debug(f"Cannot find metric linked to {ecoflow_payload_key}")
-        return False
+            # Reconnect if the broker went quiet, checked here instead of on a dedicated timer thread
+            if self.mqtt:
+                self.mqtt.idle_reconnect()
 
     def process_payload(self, params):
-        log.debug(f"Processing params: {params}")
-        for ecoflow_payload_key in params.keys():
-            ecoflow_payload_value = params[ecoflow_payload_key]
-            if not isinstance(ecoflow_payload_value, (int, float)):
+        if log.getLogger().isEnabledFor(log.DEBUG):
+            log.debug("Processing params: %s", params)
+        # Drive the loop from the keys actually present: a device splits its state across messages that each carry
+        # a different subset of keys, so walking every known metric per message would mostly find nothing to set.
+        # Bind the lookup once instead of resolving self.metrics.get for every key
+        get_metric = self.metrics.get
+        for ecoflow_payload_key, ecoflow_payload_value in params.items():
+            if not isinstance(ecoflow_payload_value, NUMERIC_TYPES):
                 log.warning(f"Skipping unsupported metric {ecoflow_payload_key}: {ecoflow_payload_value}")
                 continue
 
-            metric = self.get_metric_by_ecoflow_payload_key(ecoflow_payload_key)
-            if not metric:
+            metric = get_metric(ecoflow_payload_key)
+            if metric is None:
+                if ecoflow_payload_key in self.skipped_keys:
+                    continue
                 try:
                     metric = EcoflowMetric(ecoflow_payload_key, self.device_name)
                 except EcoflowMetricException as error:
                     log.error(error)
+                    self.skipped_keys.add(ecoflow_payload_key)
+                    continue
+                if metric.name in self.metric_names:
+                    log.error(f"Skipping payload key {ecoflow_payload_key}: metric name {metric.name} is already in use")
+                    self.skipped_keys.add(ecoflow_payload_key)
                     continue
+                self.metric_names.add(metric.name)
                 log.info(f"Created new metric from payload key {metric.ecoflow_payload_key} -> {metric.name}")
-                self.metrics_collector.append(metric)
+                # The same keys arrive in every payload, keep a single interned copy of each as the lookup key
+                self.metrics[sys.intern(ecoflow_payload_key)] = metric
 
             metric.set(ecoflow_payload_value)
 
             if ecoflow_payload_key == 'inv.acInVol' and ecoflow_payload_value == 0:
-                ac_in_current = self.get_metric_by_ecoflow_payload_key('inv.acInAmp')
+                ac_in_current = get_metric('inv.acInAmp')
                 if ac_in_current:
                     log.debug("Set AC inverter input current to zero because of zero inverter voltage")
                     ac_in_current.set(0)
@@ -385,11 +480,11 @@ def main():
         log.error(error)
         sys.exit(1)
 
-    message_queue = Queue()
+    message_queue = MessageQueue()
 
-    EcoflowMQTT(message_queue, device_sn, auth.mqtt_username, auth.mqtt_password, auth.mqtt_url, auth.mqtt_port, auth.mqtt_client_id, timeout_seconds)
+    ecoflow_mqtt = EcoflowMQTT(message_queue, device_sn, auth.mqtt_username, auth.mqtt_password, auth.mqtt_url, auth.mqtt_port, auth.mqtt_client_id, timeout_seconds)
 
-    metrics = Worker(message_queue, device_name, collecting_interval_seconds)
+    metrics = Worker(message_queue, device_name, collecting_interval_seconds, ecoflow_mqtt)
 
     start_http_server(exporter_port)
 